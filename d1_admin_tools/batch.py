@@ -0,0 +1,331 @@
+'''
+Concurrent, journaled execution of an operation over many identifiers.
+
+Used by the scripts that change content in bulk, such as d1delete and d1archive.
+Each identifier is resolved before and after the operation, calls against the CN
+are limited by a token bucket, and the outcome for each identifier is recorded
+in a SQLite journal so that an interrupted run can be repeated without
+repeating work already completed.
+'''
+
+import json
+import time
+import sqlite3
+import logging
+import datetime
+import threading
+import concurrent.futures
+from . import operations
+
+DEFAULT_BATCH_WORKERS = 4
+DEFAULT_BATCH_RATE = 5.0 #Requests per second sent to the CN
+DEFAULT_BATCH_BURST = 5
+DEFAULT_BATCH_JOURNAL = 'd1batch_journal.sqlite'
+
+#Operations outstanding per worker, bounds memory for long lists of identifiers
+BATCH_QUEUE_FACTOR = 4
+
+#States recorded in the journal
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATE_UNRESOLVED = 'unresolved'
+STATE_ERROR = 'error'
+
+
+def readPidFile(file_name):
+  '''
+  Read identifiers from a file, one per line, ignoring blank lines and duplicates.
+
+  :param file_name: path to the file
+  :return: list of identifiers in the order they appear
+  '''
+  pids = []
+  seen = set()
+  with open(file_name, 'r', encoding='utf-8') as pid_file:
+    for pid in pid_file:
+      pid = pid.strip()
+      if len(pid) > 0 and pid not in seen:
+        seen.add(pid)
+        pids.append(pid)
+  return pids
+
+
+def addBatchArguments(parser):
+  '''
+  Add the options controlling batch execution to an argparse parser.
+  '''
+  parser.add_argument('--workers', type=int, default=DEFAULT_BATCH_WORKERS,
+                      help="Batch mode - identifiers processed concurrently (default: %(default)s)")
+  parser.add_argument('--rate', type=float, default=DEFAULT_BATCH_RATE,
+                      help="Batch mode - maximum CN requests per second, 0 for no limit (default: %(default)s)")
+  parser.add_argument('--burst', type=int, default=DEFAULT_BATCH_BURST,
+                      help="Batch mode - maximum CN requests in a burst (default: %(default)s)")
+  parser.add_argument('--journal', default=DEFAULT_BATCH_JOURNAL,
+                      help="Batch mode - journal of completed identifiers (default: %(default)s)")
+
+
+def reportSummary(entries, dest):
+  '''
+  Write one line per entry and return the number of entries in each state.
+
+  :param entries: iterable of entries from BatchExecutor.run
+  :param dest: file to write to
+  :return: dict of {state: count}
+  '''
+  counts = {}
+  for entry in entries:
+    counts[entry['state']] = counts.get(entry['state'], 0) + 1
+    status = None
+    if entry['result'] is not None:
+      status = entry['result'].get('status')
+    dest.write("{0}\t{1}\t{2}\t{3}\n".format(entry['state'], status, entry['pid'], entry['message'] or ''))
+    dest.flush()
+  return counts
+
+
+class TokenBucket(object):
+  '''
+  Thread safe token bucket rate limiter.
+
+  Tokens accumulate at rate per second up to burst. acquire() blocks until a
+  token is available. A rate of 0 or less disables the limit.
+  '''
+
+  def __init__(self, rate=DEFAULT_BATCH_RATE, burst=DEFAULT_BATCH_BURST):
+    self.rate = float(rate)
+    self.burst = max(1.0, float(burst))
+    self._tokens = self.burst
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+
+  def acquire(self, tokens=1):
+    '''
+    Remove tokens from the bucket, waiting until they are available.
+
+    :param tokens: number of tokens to take
+    :return: seconds spent waiting
+    '''
+    if self.rate <= 0:
+      return 0.0
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= tokens:
+          self._tokens -= tokens
+          return waited
+        delay = (tokens - self._tokens) / self.rate
+      time.sleep(delay)
+      waited += delay
+
+
+class BatchJournal(object):
+  '''
+  SQLite record of the state of each identifier processed by a batch operation.
+
+  Entries are keyed by operation, environment and identifier so that a single
+  journal file can be used for different operations. Only the thread that
+  created the journal may use it.
+  '''
+
+  def __init__(self, path):
+    self._L = logging.getLogger(self.__class__.__name__)
+    self.path = path
+    self._con = sqlite3.connect(path)
+    self._con.execute("PRAGMA journal_mode=WAL")
+    self._con.executescript('''
+      CREATE TABLE IF NOT EXISTS batch_journal (
+        operation TEXT NOT NULL,
+        environment TEXT NOT NULL,
+        pid TEXT NOT NULL,
+        state TEXT NOT NULL,
+        before TEXT,
+        result TEXT,
+        after TEXT,
+        message TEXT,
+        elapsed REAL,
+        tstamp TEXT NOT NULL,
+        PRIMARY KEY (operation, environment, pid)
+      );
+      ''')
+
+
+  def completed(self, operation, environment):
+    '''
+    :return: set of identifiers for which operation completed in environment
+    '''
+    rows = self._con.execute(
+      "SELECT pid FROM batch_journal WHERE operation=? AND environment=? AND state=?",
+      (operation, environment, STATE_DONE))
+    return set(row[0] for row in rows)
+
+
+  def record(self, operation, environment, entry):
+    '''
+    Record the outcome for an identifier, replacing any previous entry.
+
+    :param entry: dict as produced by BatchExecutor
+    '''
+    self._con.execute(
+      "INSERT OR REPLACE INTO batch_journal VALUES (?,?,?,?,?,?,?,?,?,?)",
+      (operation,
+       environment,
+       entry['pid'],
+       entry['state'],
+       self._dumps(entry.get('before')),
+       self._dumps(entry.get('result')),
+       self._dumps(entry.get('after')),
+       entry.get('message'),
+       entry.get('elapsed'),
+       datetime.datetime.utcnow().isoformat() + 'Z'))
+    self._con.commit()
+
+
+  def summary(self, operation, environment):
+    '''
+    :return: dict of {state: count} for operation in environment
+    '''
+    rows = self._con.execute(
+      "SELECT state, COUNT(*) FROM batch_journal WHERE operation=? AND environment=? GROUP BY state",
+      (operation, environment))
+    return dict(rows)
+
+
+  def close(self):
+    self._con.close()
+
+
+  def _dumps(self, value):
+    if value is None:
+      return None
+    #The raw XML of resolve responses is not needed in the journal
+    if isinstance(value, dict) and 'xml' in value:
+      value = {k: v for k, v in value.items() if k != 'xml'}
+    return json.dumps(value, default=str)
+
+
+class BatchExecutor(object):
+  '''
+  Apply an operation to many identifiers with bounded concurrency.
+
+  For each identifier the executor resolves it, applies operation if it
+  resolved, then resolves it again. Each call to the CN takes a token from the
+  rate limiter. Clients are created by client_factory, once for each worker
+  thread. Outcomes are recorded in the journal by the calling thread as they
+  complete, and identifiers already completed are skipped.
+  '''
+
+  def __init__(self,
+               name,
+               environment,
+               operation,
+               client_factory,
+               journal=None,
+               workers=DEFAULT_BATCH_WORKERS,
+               rate=DEFAULT_BATCH_RATE,
+               burst=DEFAULT_BATCH_BURST):
+    '''
+    :param name: name of the operation, e.g. "delete", used as the journal key
+    :param environment: name of the environment being modified
+    :param operation: callable(client, pid) returning a dict with a "status"
+      entry set to the HTTP status of the response
+    :param client_factory: callable returning a new CN client
+    :param journal: instance of BatchJournal or None
+    :param workers: number of identifiers processed concurrently
+    :param rate: CN requests per second, 0 for unlimited
+    :param burst: maximum number of requests sent in a burst
+    '''
+    self._L = logging.getLogger(self.__class__.__name__)
+    self.name = name
+    self.environment = environment
+    self.operation = operation
+    self.client_factory = client_factory
+    self.journal = journal
+    self.workers = max(1, workers)
+    self.limiter = TokenBucket(rate=rate, burst=burst)
+    self._local = threading.local()
+
+
+  def pending(self, pids):
+    '''
+    :return: list of pids not yet completed according to the journal
+    '''
+    if self.journal is None:
+      return list(pids)
+    done = self.journal.completed(self.name, self.environment)
+    return [pid for pid in pids if pid not in done]
+
+
+  def run(self, pids):
+    '''
+    Generator that processes pids, yielding the outcome for each as it completes.
+
+    :param pids: iterable of identifiers
+    :return: yields dict with pid, state, before, result, after, message, elapsed
+    '''
+    completed = set()
+    if self.journal is not None:
+      completed = self.journal.completed(self.name, self.environment)
+    max_outstanding = self.workers * BATCH_QUEUE_FACTOR
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      outstanding = set()
+      for pid in pids:
+        if pid in completed:
+          self._L.debug("Skipping completed %s", pid)
+          continue
+        outstanding.add(executor.submit(self._process, pid))
+        if len(outstanding) >= max_outstanding:
+          done, outstanding = concurrent.futures.wait(
+            outstanding, return_when=concurrent.futures.FIRST_COMPLETED)
+          for future in done:
+            yield self._complete(future)
+      for future in concurrent.futures.as_completed(outstanding):
+        yield self._complete(future)
+
+
+  def _complete(self, future):
+    entry = future.result()
+    if self.journal is not None:
+      self.journal.record(self.name, self.environment, entry)
+    return entry
+
+
+  def _getClient(self):
+    client = getattr(self._local, 'client', None)
+    if client is None:
+      client = self.client_factory()
+      self._local.client = client
+    return client
+
+
+  def _process(self, pid):
+    entry = {'pid': pid, 'state': STATE_ERROR, 'before': None, 'result': None,
+             'after': None, 'message': None, 'elapsed': None}
+    tstart = time.time()
+    try:
+      client = self._getClient()
+      self.limiter.acquire()
+      entry['before'] = operations.resolve(client, pid)
+      if entry['before']['status']['msg'] != 'OK':
+        entry['state'] = STATE_UNRESOLVED
+        entry['message'] = entry['before']['status']['msg']
+        return entry
+      self.limiter.acquire()
+      self._L.warning("%s: %s", self.name.upper(), pid)
+      entry['result'] = self.operation(client, pid)
+      if entry['result'].get('status') == 200:
+        entry['state'] = STATE_DONE
+      else:
+        entry['state'] = STATE_FAILED
+      self.limiter.acquire()
+      entry['after'] = operations.resolve(client, pid)
+    except Exception as e:
+      self._L.error("%s failed for %s: %s", self.name, pid, e)
+      entry['state'] = STATE_ERROR
+      entry['message'] = str(e)
+    finally:
+      entry['elapsed'] = time.time() - tstart
+    return entry
@@ -44,7 +44,9 @@ Python ldap examples:
 import logging
 from pprint import pprint
 import ldap
+import ldap.dn
 from ldap import modlist
+from ldap.controls import SimplePagedResultsControl
 from d1_admin_tools.operations import expandNodeID
 
 # The list of protected node properties
@@ -59,6 +61,15 @@ ALLOWED_PROPERTIES = [
   'CN_location_lonlat',     #longitude,latitude WGS84, same order as WKT POINT
 ]
 
+NODES_BASE_DN = "dc=dataone,dc=org"
+PAGED_SEARCH_SIZE = 500 #Entries returned per page of a paged search
+PIPELINE_DEPTH = 32 #Asynchronous LDAP operations outstanding when applying changes
+
+#Actions in a property update plan
+CHANGE_ADD = 'add'
+CHANGE_MODIFY = 'modify'
+CHANGE_DELETE = 'delete'
+
 
 def getLDAPConnection(host="ldap://localhost:3890",
                       bind_dn="cn=admin,dc=dataone,dc=org", 
@@ -227,35 +238,248 @@ def listNodes(con, attrs=None):
 
 
 
-def listAllNodeProperties(con):
+def _normalizeDN(dn):
+  return ldap.dn.dn2str(ldap.dn.str2dn(dn))
+
+
+def _parentDN(dn):
+  return ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+
+
+def readAllNodeProperties(con, page_size=PAGED_SEARCH_SIZE, base_dn=NODES_BASE_DN):
+  '''Retrieve all node entries and their properties with a single paged search.
+
+  Every d1Node and d1NodeProperty entry under base_dn is retrieved with one
+  subtree search, page_size entries at a time using the Simple Paged Results
+  control, and the property entries are grouped under the DN of their node.
+
+  :param con: LDAP connection
+  :param page_size: number of entries per page
+  :return: dict of {node DN: {'dn': node DN,
+                              'node': dict of attributes of the d1Node entry,
+                              'properties': [(DN,
+                                              d1NodePropertyId,
+                                              d1NodePropertyKey,
+                                              d1NodePropertyValue), ...]
+                             }}
+    in the order the nodes were returned. Property values are the bytes read
+    from LDAP, as for readNodeProperty.
+  '''
+  q = "(|(objectClass=d1Node)(objectClass=d1NodeProperty))"
+  page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+  nodes = {}
+  properties = []
+  pages = 0
+  while True:
+    msgid = con.search_ext(base_dn, ldap.SCOPE_SUBTREE, q, serverctrls=[page_control])
+    rtype, rdata, rmsgid, serverctrls = con.result3(msgid)
+    pages += 1
+    for entry in rdata:
+      #referrals have no DN
+      if entry[0] is None:
+        continue
+      object_classes = entry[1].get('objectClass', [])
+      if b'd1NodeProperty' in object_classes:
+        properties.append(entry)
+      elif b'd1Node' in object_classes:
+        dn = _normalizeDN(entry[0])
+        nodes[dn] = {'dn': entry[0],
+                     'node': entry[1],
+                     'properties': []}
+    cookie = None
+    for control in serverctrls:
+      if control.controlType == SimplePagedResultsControl.controlType:
+        cookie = control.cookie
+    if not cookie:
+      break
+    page_control.cookie = cookie
+  for entry in properties:
+    try:
+      node = nodes[_parentDN(entry[0])]
+    except KeyError as e:
+      logging.warning("No node entry for property %s", entry[0])
+      continue
+    node['properties'].append((entry[0],
+                               _readEntryValue(entry, 'd1NodePropertyId'),
+                               _readEntryValue(entry, 'd1NodePropertyKey'),
+                               _readEntryValue(entry, 'd1NodePropertyValue')))
+  logging.debug("Read %d nodes, %d properties in %d pages", len(nodes), len(properties), pages)
+  result = {}
+  for node in nodes.values():
+    result[node['dn']] = node
+  return result
+
+
+def listAllNodeProperties(con, page_size=PAGED_SEARCH_SIZE):
   '''Retrieve a list of custom properties for all nodes.
+
+  :return: dict of {node_id: {property: value}} for each MN, with None for
+    allowed properties that are not set.
   '''
-  nodes = listNodes(con)
   result = {}
-  for node in nodes:
-    props = readNodeProperty(con, node, "*")
+  for node in readAllNodeProperties(con, page_size=page_size).values():
+    if _readEntryValue((node['dn'], node['node']), 'd1NodeType') != b'mn':
+      continue
+    node_id = _readEntryValue((node['dn'], node['node']), 'd1NodeId').decode('utf-8')
     entry = {}
     for k in ALLOWED_PROPERTIES:
       entry[k] = None
-    for prop in props['properties']:
-      if prop[2].startswith("CN_"):
-        entry[prop[2]] = prop[3]
-    result[node] = entry
+    for prop in node['properties']:
+      key = prop[2].decode('utf-8')
+      if key.startswith("CN_"):
+        entry[key] = prop[3].decode('utf-8')
+    result[node_id] = entry
   return result
 
 
+def planNodesProperties(con, nodes_properties, current=None):
+  '''Compute the changes needed to set properties on nodes.
+
+  The current properties are read with a single search. A value of None
+  deletes the property. Properties already set to the requested value are not
+  changed, and properties of nodes not present in LDAP are skipped.
+
+  :param con: LDAP connection
+  :param nodes_properties: dict of {node_id: {property: value}}
+  :param current: result of readAllNodeProperties, read from con if None
+  :return: list of dict with node_id, key, action (CHANGE_ADD, CHANGE_MODIFY or
+    CHANGE_DELETE), dn of the property entry, old value and new value
+  '''
+  if current is None:
+    current = readAllNodeProperties(con)
+  by_node_id = {}
+  for node in current.values():
+    node_id = _readEntryValue((node['dn'], node['node']), 'd1NodeId')
+    if node_id is not None:
+      by_node_id[node_id.decode('utf-8')] = node
+  requested = {}
+  for node_id, properties in nodes_properties.items():
+    requested.setdefault(expandNodeID(node_id), {}).update(properties)
+  changes = []
+  for node_id, properties in requested.items():
+    node = by_node_id.get(node_id)
+    if node is None:
+      logging.error("Node %s not found, skipping its properties", node_id)
+      continue
+    existing = {}
+    for prop in node['properties']:
+      existing[prop[2].decode('utf-8')] = prop
+    for key, value in properties.items():
+      if key not in ALLOWED_PROPERTIES:
+        raise KeyError("key must be one of {0}".format(",".join(ALLOWED_PROPERTIES)))
+      if value is not None:
+        value = str(value)
+      change = {'node_id': node_id,
+                'key': key,
+                'action': None,
+                'dn': "d1NodePropertyId={0},{1}".format(key, node['dn']),
+                'old': None,
+                'new': value}
+      prop = existing.get(key)
+      if prop is None:
+        if value is None:
+          continue
+        change['action'] = CHANGE_ADD
+      else:
+        change['dn'] = prop[0]
+        change['old'] = prop[3].decode('utf-8')
+        if value is None:
+          change['action'] = CHANGE_DELETE
+        elif value == change['old']:
+          continue
+        else:
+          change['action'] = CHANGE_MODIFY
+      changes.append(change)
+  return changes
+
+
+def formatChanges(changes):
+  '''Render a plan from planNodesProperties as a diff, one line per change grouped by node.
+
+  Changes with a result from applyChanges that is not OK have the result appended.
+
+  :return: string
+  '''
+  lines = []
+  node_id = None
+  for change in changes:
+    if change['node_id'] != node_id:
+      node_id = change['node_id']
+      lines.append(node_id)
+    if change['action'] == CHANGE_ADD:
+      line = "  + {0}: {1}".format(change['key'], change['new'])
+    elif change['action'] == CHANGE_DELETE:
+      line = "  - {0}: {1}".format(change['key'], change['old'])
+    else:
+      line = "  ~ {0}: {1} -> {2}".format(change['key'], change['old'], change['new'])
+    if change.get('result') not in (None, 'OK'):
+      line += "  FAILED: {0}".format(change['result'])
+    lines.append(line)
+  return "\n".join(lines)
+
+
+def _submitChange(con, change):
+  if change['action'] == CHANGE_ADD:
+    entry = {'objectClass': [b'top', b'd1NodeProperty'],
+             'd1NodeId': change['node_id'].encode('utf-8'),
+             'd1NodePropertyId': change['key'].encode('utf-8'),
+             'd1NodePropertyKey': change['key'].encode('utf-8'),
+             'd1NodePropertyValue': change['new'].encode('utf-8'),
+            }
+    return con.add(change['dn'], modlist.addModlist(entry))
+  if change['action'] == CHANGE_DELETE:
+    return con.delete(change['dn'])
+  old_entry = {'d1NodePropertyValue': [change['old'].encode('utf-8'), ]}
+  entry = {'d1NodePropertyValue': [change['new'].encode('utf-8'), ]}
+  return con.modify(change['dn'], modlist.modifyModlist(old_entry, entry))
+
+
+def applyChanges(con, changes, depth=PIPELINE_DEPTH):
+  '''Apply a plan from planNodesProperties with pipelined asynchronous operations.
+
+  Up to depth operations are sent before waiting for the result of the oldest,
+  so each change costs one round trip that overlaps with the others. The
+  outcome of each change is set in its 'result' entry, 'OK' or the LDAP error.
+
+  :return: number of changes that failed
+  '''
+  outstanding = []
+  failed = 0
+  pending = list(changes)
+  while len(pending) > 0 or len(outstanding) > 0:
+    while len(pending) > 0 and len(outstanding) < depth:
+      change = pending.pop(0)
+      logging.info("%s %s.%s", change['action'], change['node_id'], change['key'])
+      try:
+        outstanding.append((_submitChange(con, change), change))
+      except ldap.LDAPError as e:
+        change['result'] = str(e)
+        failed += 1
+    if len(outstanding) == 0:
+      continue
+    msgid, change = outstanding.pop(0)
+    try:
+      con.result3(msgid, all=1)
+      change['result'] = 'OK'
+    except ldap.LDAPError as e:
+      logging.error("%s %s failed: %s", change['action'], change['dn'], e)
+      change['result'] = str(e)
+      failed += 1
+  return failed
+
+
 def setNodesProperties(con, nodes_properties):
   '''Given a dict of:
     {node_id: {property: value,
                property: value}
       }
-  Call createOrUpdateNodeProperty for each entry.
+  Set the properties, changing only those that differ from the values in LDAP.
+
+  :return: list of changes from planNodesProperties with the result of each
   '''
-  for node_id in list(nodes_properties.keys()):
-    properties = nodes_properties[node_id]
-    for key in list(properties.keys()):
-      logging.info("%s set prop %s to %s", node_id, key, str(properties[key]))
-      createOrUpdateNodeProperty(con, node_id, key, properties[key])
+  changes = planNodesProperties(con, nodes_properties)
+  applyChanges(con, changes)
+  return changes
 
 
 if __name__ == "__main__":
@@ -26,6 +26,15 @@ class Node(object):
     return self._node.identifier.value()
 
 
+  def getState(self):
+    '''
+    Get the state of this node, "up" or "down"
+
+    :return: string
+    '''
+    return str(self._node.state)
+
+
   def getBaseURL(self):
     '''
     Get the baseURL of this node
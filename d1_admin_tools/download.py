@@ -0,0 +1,165 @@
+'''
+Cheap reachability probes for object download URLs.
+
+A probe retrieves at most the first few KB of an object using a ranged GET, or
+only the headers with HEAD, over a requests.Session kept per thread so that
+probes of many objects on the same node reuse connections.
+'''
+
+import time
+import logging
+import threading
+import requests
+
+DEFAULT_DOWNLOAD_TIMEOUT = 5
+DEFAULT_DOWNLOAD_MAXBYTES = 4096
+DOWNLOAD_CHUNK_SIZE = 65536 #Bytes read per iteration of the response body
+
+#Statuses reported when no HTTP response was received
+STATUS_TIMEOUT = -1
+STATUS_CONNECTION_ERROR = -2
+
+_thread_local = threading.local()
+
+
+def getSession():
+  '''
+  Return the requests.Session for the calling thread, creating it if necessary.
+
+  Sessions are not shared between threads, so probes can be run from a thread pool.
+
+  :return: instance of requests.Session
+  '''
+  session = getattr(_thread_local, 'session', None)
+  if session is None:
+    session = requests.Session()
+    _thread_local.session = session
+  return session
+
+
+def probeDownload(url,
+                  timeout=DEFAULT_DOWNLOAD_TIMEOUT,
+                  max_bytes=DEFAULT_DOWNLOAD_MAXBYTES,
+                  use_head=False,
+                  session=None):
+  '''
+  Probe a download URL, transferring at most max_bytes of the body.
+
+  A GET is sent with ``Range: bytes=0-<max_bytes - 1>``. Servers that ignore the
+  range respond with 200 and the full body, which is read only until max_bytes
+  have arrived or timeout seconds have passed. With use_head, a HEAD request is
+  sent instead, falling back to the ranged GET if the server does not allow HEAD.
+
+  :param url: URL to probe
+  :param timeout: seconds allowed for connecting, for each read and for the whole body
+  :param max_bytes: maximum number of body bytes to retrieve
+  :param use_head: try HEAD before GET
+  :param session: requests.Session to use, default is one per thread
+  :return: dict with
+    url,
+    status: HTTP status, STATUS_TIMEOUT or STATUS_CONNECTION_ERROR,
+    method: HEAD or GET,
+    ttfb: seconds until the first body byte, or the headers if no body was read,
+    elapsed: seconds for the whole probe,
+    bytes: number of body bytes read,
+    throughput: body bytes per second after the response headers, or None,
+    content_length: value of the Content-Length header, or None,
+    ranged: True if the server honored the range request,
+    error: message if the probe failed, else None
+  '''
+  _l = logging.getLogger('probeDownload')
+  if session is None:
+    session = getSession()
+  result = {
+    'url': url,
+    'status': STATUS_TIMEOUT,
+    'method': 'GET',
+    'ttfb': None,
+    'elapsed': None,
+    'bytes': 0,
+    'throughput': None,
+    'content_length': None,
+    'ranged': False,
+    'error': None,
+  }
+  tstart = time.time()
+  try:
+    if use_head:
+      result['method'] = 'HEAD'
+      response = session.head(url, timeout=timeout, allow_redirects=True)
+      response.close()
+      if response.status_code not in (405, 501):
+        result['status'] = response.status_code
+        result['ttfb'] = time.time() - tstart
+        result['elapsed'] = result['ttfb']
+        result['content_length'] = _contentLength(response)
+        return result
+      _l.debug("HEAD not allowed for %s, using GET", url)
+      result['method'] = 'GET'
+    headers = {'Range': 'bytes=0-{0}'.format(max(0, max_bytes - 1))}
+    response = session.get(url, timeout=timeout, stream=True, headers=headers)
+    theaders = time.time()
+    try:
+      result['status'] = response.status_code
+      result['ranged'] = response.status_code == 206
+      result['content_length'] = _contentLength(response)
+      chunk_size = max(1, min(DOWNLOAD_CHUNK_SIZE, max_bytes))
+      tfirst = None
+      for chunk in response.iter_content(chunk_size=chunk_size):
+        if tfirst is None:
+          tfirst = time.time()
+          result['ttfb'] = tfirst - tstart
+        result['bytes'] += len(chunk)
+        if result['bytes'] >= max_bytes:
+          _l.debug("Request terminated by maximum bytes")
+          break
+        if time.time() - tstart > timeout:
+          _l.info("Request terminated by total time")
+          break
+      if tfirst is None:
+        result['ttfb'] = time.time() - tstart
+      else:
+        transfer_secs = time.time() - theaders
+        if transfer_secs > 0:
+          result['throughput'] = result['bytes'] / transfer_secs
+    finally:
+      response.close()
+  except requests.exceptions.Timeout as e:
+    _l.info("Request timed out: %s", url)
+    result['status'] = STATUS_TIMEOUT
+    result['error'] = str(e)
+  except requests.exceptions.RequestException as e:
+    _l.info("Request failed with connection error: %s", str(e))
+    result['status'] = STATUS_CONNECTION_ERROR
+    result['error'] = str(e)
+  result['elapsed'] = time.time() - tstart
+  return result
+
+
+def _contentLength(response):
+  try:
+    return int(response.headers['Content-Length'])
+  except (KeyError, ValueError):
+    return None
+
+
+# TODO: support authenticated request
+def testDownload(url,
+                 terminate_secs=DEFAULT_DOWNLOAD_TIMEOUT,
+                 terminate_max_bytes=DEFAULT_DOWNLOAD_MAXBYTES):
+  '''
+  Test GET operation, terminating the request
+
+  Retrieves at most terminate_max_bytes from url within terminate_secs seconds.
+  A 206 response to the range request is reported as 200, as it was before ranged
+  requests were used.
+
+  :param url: URL target for GET request
+  :param terminate_secs: Number of seconds after which connection is terminated
+  :param terminate_max_bytes: maximum number of bytes to download before terminating
+  :return: status code, -1 if connection timed out on try; -2 on connection error
+  '''
+  result = probeDownload(url, timeout=terminate_secs, max_bytes=terminate_max_bytes)
+  if result['status'] == 206:
+    return 200
+  return result['status']
@@ -0,0 +1,113 @@
+'''
+Run an operation against several environments or CN hosts concurrently.
+
+Each target is handled by its own thread and results are yielded as they
+complete, tagged with the environment and host, so a check across all
+environments takes the time of the slowest target rather than the sum. A
+target that has not completed within the timeout is reported as timed out and
+abandoned; the operation should use its own network timeouts so that abandoned
+threads also finish.
+'''
+
+import time
+import queue
+import logging
+import threading
+
+DEFAULT_FANOUT_TIMEOUT = 30 #Seconds allowed for each target
+
+#Status of a fan out result
+FANOUT_OK = 'ok'
+FANOUT_ERROR = 'error'
+FANOUT_TIMEOUT = 'timeout'
+
+
+def environmentTargets(config, environments=None):
+  '''
+  Targets for each environment.
+
+  :param config: instance of D1Configuration
+  :param environments: list of environment names, default is all configured environments
+  :return: list of dict with environment and host (the primary host)
+  '''
+  if environments is None:
+    environments = config.environments()
+  return [{'environment': env, 'host': config.envPrimaryHost(env)} for env in environments]
+
+
+def hostTargets(config, environments=None, primary=False):
+  '''
+  Targets for each CN host of the environments.
+
+  :param config: instance of D1Configuration
+  :param environments: list of environment names, default is all configured environments
+  :param primary: only the primary host of each environment
+  :return: list of dict with environment and host
+  '''
+  if primary:
+    return environmentTargets(config, environments=environments)
+  if environments is None:
+    environments = config.environments()
+  targets = []
+  for env in environments:
+    for host in config.hosts(env):
+      targets.append({'environment': env, 'host': host})
+  return targets
+
+
+def fanOut(targets, operation, timeout=DEFAULT_FANOUT_TIMEOUT, **kwargs):
+  '''
+  Generator running operation against all targets concurrently.
+
+  :param targets: list of dict with at least environment and host, e.g. from
+    environmentTargets or hostTargets
+  :param operation: callable(target, **kwargs) returning the result for target
+  :param timeout: seconds allowed for each target, None for no limit
+  :param kwargs: passed to operation
+  :return: yields dict with environment, host, status (FANOUT_OK, FANOUT_ERROR
+    or FANOUT_TIMEOUT), result, error message and elapsed seconds, in the order
+    the targets complete
+  '''
+  _l = logging.getLogger('fanOut')
+  completed = queue.Queue()
+
+  def runner(i, target):
+    try:
+      completed.put((i, operation(target, **kwargs), None))
+    except Exception as e:
+      _l.debug("%s %s: %s", target['environment'], target['host'], e)
+      completed.put((i, None, e))
+
+  tstart = time.time()
+  remaining = set()
+  for i, target in enumerate(targets):
+    name = "{0}-{1}".format(target['environment'], target['host'])
+    thread = threading.Thread(target=runner, args=(i, target), name=name, daemon=True)
+    thread.start()
+    remaining.add(i)
+  while len(remaining) > 0:
+    wait = None
+    if timeout is not None:
+      wait = max(0, tstart + timeout - time.time())
+    try:
+      i, value, error = completed.get(timeout=wait)
+    except queue.Empty:
+      for i in sorted(remaining):
+        _l.warning("%s %s timed out after %s seconds", targets[i]['environment'], targets[i]['host'], timeout)
+        yield _fanOutResult(targets[i], FANOUT_TIMEOUT, None,
+                            "Timed out after {0} seconds".format(timeout), time.time() - tstart)
+      return
+    remaining.discard(i)
+    if error is None:
+      yield _fanOutResult(targets[i], FANOUT_OK, value, None, time.time() - tstart)
+    else:
+      yield _fanOutResult(targets[i], FANOUT_ERROR, None, str(error), time.time() - tstart)
+
+
+def _fanOutResult(target, status, result, error, elapsed):
+  return {'environment': target['environment'],
+          'host': target['host'],
+          'status': status,
+          'result': result,
+          'error': error,
+          'elapsed': elapsed}
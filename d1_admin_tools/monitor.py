@@ -0,0 +1,403 @@
+'''
+Node health probes and a local history of their results.
+
+The probes (ping and listObjects counts) are used by d1nodes for a single
+survey and by d1nodemonitor, which samples them periodically and records them in
+a SQLite store from which latency percentiles, availability and object count
+growth are reported, including as check_mk local check output.
+'''
+
+import time
+import math
+import sqlite3
+import logging
+import threading
+import http.client
+import requests
+from d1_client import cnclient_2_0
+
+PING_TIMEOUT = 3
+GETOBJECT_TIMEOUT = 10
+
+DEFAULT_MONITOR_DATABASE = 'd1nodemonitor.sqlite'
+DEFAULT_PING_INTERVAL = 300 #Seconds between pings of each node
+DEFAULT_COUNT_INTERVAL = 3600 #Seconds between listObjects counts of each node
+DEFAULT_REPORT_WINDOW = 86400 #Seconds of history summarized in reports
+DEFAULT_RETENTION_DAYS = 90
+
+#check_mk thresholds, latency is the p95 in milliseconds, availability a percentage
+DEFAULT_LATENCY_WARN = 2000
+DEFAULT_LATENCY_CRIT = 5000
+DEFAULT_AVAILABILITY_WARN = 99.0
+DEFAULT_AVAILABILITY_CRIT = 95.0
+
+#check_mk local check states
+CHECK_OK = 0
+CHECK_WARN = 1
+CHECK_CRIT = 2
+CHECK_UNKNOWN = 3
+CHECK_STATE_NAMES = ['OK', 'WARN', 'CRIT', 'UNKNOWN']
+
+_thread_local = threading.local()
+
+
+def testNodePing(node_wrap, timeout=PING_TIMEOUT):
+  '''
+  Returns (http status, milliseconds) for /monitor/ping
+
+  :param node_wrap: instance of d1_nodes.Node
+  :return: dict with status, ping (seconds) and status_message
+  '''
+  try:
+    timeout = int(timeout)
+  except Exception:
+    timeout = PING_TIMEOUT
+  logging.info("Pinging %s", node_wrap.getID())
+  client = node_wrap.getClient(allow_redirects=False, timeout=timeout)
+  tstart = time.time()
+  message = {"status": "-9999", "ping": 0, "status_message": ""}
+  try:
+    response = client.pingResponse()
+    message["status"] = response.status_code
+    message["status_message"] = http.client.responses[response.status_code]
+  except requests.exceptions.SSLError as ex:
+    logging.error(ex)
+    message["status"] = -1
+    message["status_message"] = str(ex)
+  except requests.exceptions.ConnectionError as ex:
+    logging.error(ex)
+    message["status"] = -2
+    message["status_message"] = str(ex)
+  finally:
+    tend = time.time()
+    message["ping"] = tend - tstart
+    return message
+
+
+def getIndexObjectCount(nodes, node_id):
+  index_count = 0
+  return index_count
+
+
+def getThreadCNClient(nodes, timeout=GETOBJECT_TIMEOUT):
+  '''
+  Returns a CN client for the calling thread, clients are not shared between threads.
+
+  Clients are kept per CN base URL, so a thread that serves several environments
+  uses the CN of the environment of nodes. They are created directly rather than
+  through nodes.getClient, which replaces the client shared by the primary Node.
+
+  :param nodes: instance of d1_nodes.Nodes
+  :return: CN client
+  '''
+  clients = getattr(_thread_local, 'cn_clients', None)
+  if clients is None:
+    clients = {}
+    _thread_local.cn_clients = clients
+  key = (nodes.base_url, timeout)
+  client = clients.get(key)
+  if client is None:
+    client = cnclient_2_0.CoordinatingNodeClient_2_0(
+      nodes.base_url, allow_redirects=False, timeout=timeout)
+    clients[key] = client
+  return client
+
+
+def getObjectCount(nodes, node_id, mn_ping_status, timeout=GETOBJECT_TIMEOUT, cn_client=None):
+  '''
+  Get the number of objects the CN lists for a node, and the number the node
+  lists itself if mn_ping_status is 200.
+
+  :param nodes: instance of d1_nodes.Nodes
+  :param node_id: identifier of the node
+  :param mn_ping_status: status of the last ping of the node
+  :param cn_client: CN client to use, default is the shared client of nodes
+  :return: dict with cn_object_count, mn_object_count and index_count, None for
+    a count that was not retrieved
+  '''
+  try:
+    timeout = int(timeout)
+  except Exception:
+    timeout = GETOBJECT_TIMEOUT
+  logging.info("List objects for node: %s", node_id)
+  res = {"cn_object_count": None, "mn_object_count": None, "index_count": None}
+  #get CN count
+  if cn_client is None:
+    cn_client = nodes.getClient(timeout=timeout)
+  try:
+    kwparams = {"count": 0, "nodeId": node_id}
+    cn_lo = cn_client.listObjects(**kwparams)
+    res["cn_object_count"] = cn_lo.total
+  except Exception as ex:
+    logging.exception(ex)
+    return res
+  res["index_count"] = getIndexObjectCount(nodes, node_id)
+  if str(mn_ping_status) == "200":
+    #get MN count
+    try:
+      kwparams = {"count": 0}
+      mn_client = nodes.getClient(node_id, timeout=timeout)
+      mn_lo = mn_client.listObjects(**kwparams)
+      res["mn_object_count"] = mn_lo.total
+    except Exception as ex:
+      logging.exception(ex)
+      return res
+  return res
+
+
+def percentile(values, p):
+  '''
+  Percentile of values by linear interpolation between closest ranks.
+
+  :param values: sorted list of numbers
+  :param p: percentile, 0 - 100
+  :return: value or None if values is empty
+  '''
+  if len(values) == 0:
+    return None
+  k = (len(values) - 1) * p / 100.0
+  f = math.floor(k)
+  c = math.ceil(k)
+  if f == c:
+    return values[int(k)]
+  return values[f] * (c - k) + values[c] * (k - f)
+
+
+class NodeHealthStore(object):
+  '''
+  SQLite time series of node pings and object counts.
+
+  Samples are stored as integers (epoch seconds, milliseconds and counts) in
+  tables keyed by node and time, so a year of five minute pings of a hundred
+  nodes is a few hundred MB. Only the thread that created the store may use it.
+  '''
+
+  def __init__(self, path=DEFAULT_MONITOR_DATABASE):
+    self._L = logging.getLogger(self.__class__.__name__)
+    self.path = path
+    self._con = sqlite3.connect(path)
+    self._con.execute("PRAGMA journal_mode=WAL")
+    self._con.executescript('''
+      CREATE TABLE IF NOT EXISTS node (
+        id INTEGER PRIMARY KEY,
+        environment TEXT NOT NULL,
+        node_id TEXT NOT NULL,
+        UNIQUE (environment, node_id)
+      );
+      CREATE TABLE IF NOT EXISTS ping (
+        node INTEGER NOT NULL,
+        t INTEGER NOT NULL,
+        status INTEGER NOT NULL,
+        ms INTEGER NOT NULL,
+        PRIMARY KEY (node, t)
+      ) WITHOUT ROWID;
+      CREATE TABLE IF NOT EXISTS object_count (
+        node INTEGER NOT NULL,
+        t INTEGER NOT NULL,
+        cn_count INTEGER,
+        mn_count INTEGER,
+        PRIMARY KEY (node, t)
+      ) WITHOUT ROWID;
+      ''')
+    self._node_keys = {}
+
+
+  def close(self):
+    self._con.close()
+
+
+  def nodeKey(self, environment, node_id):
+    '''
+    :return: integer key for the node, added if not yet present
+    '''
+    key = self._node_keys.get((environment, node_id))
+    if key is not None:
+      return key
+    self._con.execute("INSERT OR IGNORE INTO node (environment, node_id) VALUES (?,?)",
+                      (environment, node_id))
+    row = self._con.execute("SELECT id FROM node WHERE environment=? AND node_id=?",
+                            (environment, node_id)).fetchone()
+    self._node_keys[(environment, node_id)] = row[0]
+    return row[0]
+
+
+  def nodes(self, environment=None):
+    '''
+    :return: list of (environment, node_id) with samples in the store
+    '''
+    if environment is None:
+      rows = self._con.execute("SELECT environment, node_id FROM node ORDER BY environment, node_id")
+    else:
+      rows = self._con.execute(
+        "SELECT environment, node_id FROM node WHERE environment=? ORDER BY node_id", (environment, ))
+    return [tuple(row) for row in rows]
+
+
+  def addPing(self, environment, node_id, t, status, seconds):
+    '''
+    Record a ping.
+
+    :param t: time of the ping, epoch seconds
+    :param status: HTTP status, or negative for no response
+    :param seconds: time taken by the ping
+    '''
+    self._con.execute("INSERT OR REPLACE INTO ping VALUES (?,?,?,?)",
+                      (self.nodeKey(environment, node_id), int(t), int(status), int(round(seconds * 1000))))
+
+
+  def addCount(self, environment, node_id, t, cn_count, mn_count):
+    '''
+    Record object counts, None for a count that was not retrieved.
+    '''
+    self._con.execute("INSERT OR REPLACE INTO object_count VALUES (?,?,?,?)",
+                      (self.nodeKey(environment, node_id), int(t), cn_count, mn_count))
+
+
+  def commit(self):
+    self._con.commit()
+
+
+  def lastCountTime(self, environment, node_id):
+    '''
+    :return: epoch seconds of the last object count of the node, or 0
+    '''
+    row = self._con.execute("SELECT MAX(t) FROM object_count WHERE node=?",
+                            (self.nodeKey(environment, node_id), )).fetchone()
+    if row[0] is None:
+      return 0
+    return row[0]
+
+
+  def prune(self, before):
+    '''
+    Remove samples older than before, epoch seconds.
+    '''
+    self._con.execute("DELETE FROM ping WHERE t < ?", (int(before), ))
+    self._con.execute("DELETE FROM object_count WHERE t < ?", (int(before), ))
+    self._con.commit()
+
+
+  def summary(self, environment, node_id, window=DEFAULT_REPORT_WINDOW, now=None):
+    '''
+    Summarize the samples of a node over the last window seconds.
+
+    Latency percentiles are computed from pings that returned 200. Growth is
+    the change between the first and last count within the window, and the
+    rate is that change scaled to a day.
+
+    :return: dict with environment, node_id, pings, available, availability (%),
+      p50, p95, p99 (ms), last_status, last_ping, cn_count, mn_count,
+      cn_growth, mn_growth, cn_growth_per_day, mn_growth_per_day
+    '''
+    if now is None:
+      now = time.time()
+    since = int(now - window)
+    key = self.nodeKey(environment, node_id)
+    res = {'environment': environment,
+           'node_id': node_id,
+           'pings': 0,
+           'available': 0,
+           'availability': None,
+           'p50': None,
+           'p95': None,
+           'p99': None,
+           'last_status': None,
+           'last_ping': None,
+           'cn_count': None,
+           'mn_count': None,
+           'cn_growth': None,
+           'mn_growth': None,
+           'cn_growth_per_day': None,
+           'mn_growth_per_day': None,
+           }
+    latencies = []
+    for t, status, ms in self._con.execute(
+        "SELECT t, status, ms FROM ping WHERE node=? AND t>=? ORDER BY t", (key, since)):
+      res['pings'] += 1
+      res['last_status'] = status
+      res['last_ping'] = t
+      if status == 200:
+        res['available'] += 1
+        latencies.append(ms)
+    if res['pings'] > 0:
+      res['availability'] = 100.0 * res['available'] / res['pings']
+    latencies.sort()
+    for p in (50, 95, 99):
+      res['p{0}'.format(p)] = percentile(latencies, p)
+    counts = self._con.execute(
+      "SELECT t, cn_count, mn_count FROM object_count WHERE node=? AND t>=? ORDER BY t",
+      (key, since)).fetchall()
+    if len(counts) > 0:
+      res['cn_count'] = counts[-1][1]
+      res['mn_count'] = counts[-1][2]
+    for i, name in ((1, 'cn'), (2, 'mn')):
+      samples = [(c[0], c[i]) for c in counts if c[i] is not None]
+      if len(samples) < 2:
+        continue
+      growth = samples[-1][1] - samples[0][1]
+      res[name + '_growth'] = growth
+      elapsed = samples[-1][0] - samples[0][0]
+      if elapsed > 0:
+        res[name + '_growth_per_day'] = growth * 86400.0 / elapsed
+    return res
+
+
+def checkMKService(summary):
+  '''
+  :return: check_mk service name for a node summary, e.g. D1_production_KNB
+  '''
+  node_id = summary['node_id']
+  if node_id.startswith('urn:node:'):
+    node_id = node_id[len('urn:node:'):]
+  return "D1_{0}_{1}".format(summary['environment'], node_id).replace(" ", "_")
+
+
+def checkMKLine(summary,
+                latency_warn=DEFAULT_LATENCY_WARN,
+                latency_crit=DEFAULT_LATENCY_CRIT,
+                availability_warn=DEFAULT_AVAILABILITY_WARN,
+                availability_crit=DEFAULT_AVAILABILITY_CRIT):
+  '''
+  Format a node summary as a check_mk local check line:
+
+    <state> <service> <perfdata> <text>
+
+  The state is CRIT if availability is below availability_crit or the last ping
+  failed, WARN if availability is below availability_warn or the p95 latency is
+  above latency_warn, and UNKNOWN if there are no pings in the window.
+
+  :param summary: dict from NodeHealthStore.summary
+  :return: str
+  '''
+  service = checkMKService(summary)
+  if summary['pings'] == 0:
+    return "{0} {1} - {2} - no pings recorded".format(CHECK_UNKNOWN, service, CHECK_STATE_NAMES[CHECK_UNKNOWN])
+  state = CHECK_OK
+  availability = summary['availability']
+  p95 = summary['p95']
+  if availability < availability_crit or summary['last_status'] != 200:
+    state = CHECK_CRIT
+  elif availability < availability_warn:
+    state = CHECK_WARN
+  if p95 is not None:
+    if p95 > latency_crit:
+      state = max(state, CHECK_CRIT)
+    elif p95 > latency_warn:
+      state = max(state, CHECK_WARN)
+  perf = ["availability={0:.2f};{1};{2};0;100".format(availability, availability_warn, availability_crit)]
+  for p in ('p50', 'p95', 'p99'):
+    if summary[p] is not None:
+      if p == 'p95':
+        perf.append("{0}={1:.0f};{2};{3}".format(p, summary[p], latency_warn, latency_crit))
+      else:
+        perf.append("{0}={1:.0f}".format(p, summary[p]))
+  for c in ('cn_count', 'mn_count'):
+    if summary[c] is not None:
+      perf.append("{0}={1}".format(c, summary[c]))
+  text = "availability {0:.1f}% of {1} pings, last status {2}".format(
+    availability, summary['pings'], summary['last_status'])
+  if p95 is not None:
+    text += ", p95 {0:.0f} ms".format(p95)
+  if summary['cn_growth_per_day'] is not None:
+    text += ", {0:+.0f} objects/day".format(summary['cn_growth_per_day'])
+  return "{0} {1} {2} {3} - {4}".format(state, service, "|".join(perf), CHECK_STATE_NAMES[state], text)
@@ -8,8 +8,6 @@ import logging
 import time
 from getpass import getpass
 from io import StringIO
-#from fabric.api import sudo, get, put, run
-#from fabric.context_managers import env
 
 
 def expandNodeID(nodeId):
@@ -46,12 +44,58 @@ def tmpFileName(tmp_dir="/tmp", prefix="", ext="txt"):
   return os.path.join(tmp_dir, "{0}_{1}.{2}".format(prefix, ts, ext))
 
 
+#========================
+#== DataONE Operations ==
+
+def resolve(client, pid):
+  '''Resolve the provided identifier using client.
+
+  :param client: An instance of CoordinatingNodeClient
+  :param pid: Identifier to resolve
+  :return: Dictionary mimicking an objectLocationList with addition of status entry
+  '''
+  _l = logging.getLogger('resolve')
+  response = {'status': {'msg': '', 'code': -10}, 'xml': None}
+  try:
+    res = client.resolveResponse(pid)
+    obj_locs = client._read_dataone_type_response(res,
+                                                  'ObjectLocationList',
+                                                  response_is_303_redirect=True)
+    response['status']['msg'] = 'OK'
+    response['status']['code'] = res.status_code
+    response['xml'] = res.content
+    response['identifier'] = str(obj_locs.identifier.value())
+    response['id_is_sid'] = not (pid == response['identifier'])
+    response['objectLocation'] = []
+    for loc in obj_locs.objectLocation:
+      response['objectLocation'].append({
+        'url': str(loc.url),
+        'nodeIdentifier': str(loc.nodeIdentifier.value()),
+        'baseURL': str(loc.baseURL),
+        'version': list(map(str, loc.version)),
+        'preference': str(loc.preference),
+      })
+  except Exception as e:
+    _l.info(e)
+    response['status']['msg'] = str(e)
+  return response
+
+
 #=======================
 #== Fabric Operations ==
+#Fabric is imported when needed so the other operations can be used without it.
+
+LDAP_URI = "ldap://localhost"
+LDAP_ADMIN_DN = "cn=admin,dc=dataone,dc=org"
+NODES_BASE_DN = "dc=dataone,dc=org"
+LDAP_RESULT_OK = "OK"
+LDAP_RESULT_NOT_ATTEMPTED = "Not attempted"
+
 
 def listCNClientCertificates():
   '''List the contents of /etc/dataone/client/private
   '''
+  from fabric.api import sudo
   cmd = "ls -la /etc/dataone/client/private"
   sudo(cmd)
 
@@ -65,6 +109,7 @@ def getCNClientCertificate(cert_file_name):
     cert_file_name (str): Name of the certificate file located under
         /etc/dataone/client/private to be retrieved.
   '''
+  from fabric.api import env, get
   host_name = env.host_string
   target_folder = os.path.join(os.path.expanduser('~'), ".dataone/certificates/{0}".format(host_name))
   if not os.path.exists(target_folder):
@@ -77,125 +122,207 @@ def getCNClientCertificate(cert_file_name):
   get(source_file, target_file, use_sudo=True)
 
 
-def setNodeSynchronize(node_id, state, ldap_pass=None):
+def nodeDN(node_id):
+  return "cn={0},{1}".format(expandNodeID(node_id), NODES_BASE_DN)
+
+
+def groupNodeChanges(changes):
+  '''Group (node_id, attribute, value) changes by node entry.
+
+  :param changes: iterable of (node_id, attribute, value)
+  :return: list of (DN, [(attribute, value), ...]) in the order nodes first appear
+  '''
+  entries = {}
+  for node_id, attribute, value in changes:
+    entries.setdefault(nodeDN(node_id), []).append((attribute, value))
+  return list(entries.items())
+
+
+def nodeChangesLDIF(changes):
+  '''Build a single LDIF that replaces attribute values on node entries.
+
+  :param changes: iterable of (node_id, attribute, value)
+  :return: LDIF text with one modify record per node
+  '''
+  ldiff = StringIO()
+  for dn, attributes in groupNodeChanges(changes):
+    ldiff.write("dn: {0}\n".format(dn))
+    ldiff.write("changetype: modify\n")
+    for i, (attribute, value) in enumerate(attributes):
+      if i > 0:
+        ldiff.write("-\n")
+      ldiff.write("replace: {0}\n".format(attribute))
+      ldiff.write("{0}: {1}\n".format(attribute, value))
+    ldiff.write("\n")
+  return ldiff.getvalue()
+
+
+def parseLdapmodifyOutput(output, dns, return_code=0):
+  '''Get the result for each entry from the output of ldapmodify -c.
+
+  ldapmodify reports 'modifying entry "<DN>"' for each record, followed by a
+  line starting with "ldap_" if the change failed.
+
+  An error that can not be attributed to a record, such as one that arrives
+  before any 'modifying entry' line, is reported against every record that
+  would otherwise be OK or not attempted when ldapmodify exited non-zero and no
+  record failed, e.g. all records when the bind failed.
+
+  :param output: stdout and stderr of ldapmodify
+  :param dns: DNs of the records in the LDIF
+  :param return_code: exit status of ldapmodify
+  :return: dict of {DN: LDAP_RESULT_OK or the error message}
+  '''
+  results = {}
+  for dn in dns:
+    results[dn] = LDAP_RESULT_NOT_ATTEMPTED
+  current = None
+  unattributed = []
+  n_failed = 0
+  for line in output.splitlines():
+    line = line.strip()
+    if line.startswith('modifying entry "') and line.endswith('"'):
+      current = line[len('modifying entry "'):-1]
+      results[current] = LDAP_RESULT_OK
+    elif line.startswith("ldap_"):
+      message = line.split(":", 1)[-1].strip()
+      if current is None or results[current] != LDAP_RESULT_OK:
+        unattributed.append(message)
+      else:
+        results[current] = message
+        n_failed += 1
+  if return_code != 0 and n_failed == 0:
+    message = "; ".join(unattributed)
+    if message == "":
+      message = "ldapmodify exited with status {0}".format(return_code)
+    for dn, result in results.items():
+      if result in (LDAP_RESULT_OK, LDAP_RESULT_NOT_ATTEMPTED):
+        results[dn] = message
+  return results
+
+
+def applyNodeChanges(changes, ldap_pass=None, con=None):
+  '''Replace attribute values on many node entries in one operation.
+
+  Without con, a single LDIF with one record per node is uploaded to the
+  current fabric host and applied with one "ldapmodify -c", which continues
+  past failed records. With con, a python-ldap connection made directly or
+  through a tunnel, the records are sent as asynchronous modify operations
+  and the results collected afterwards.
+
+  :param changes: list of (node_id, attribute, value)
+  :param ldap_pass: LDAP admin password, prompted for if needed and not provided
+  :param con: optional python-ldap connection bound as admin
+  :return: list of dict with dn, changes ([(attribute, value), ...]) and result
+    (LDAP_RESULT_OK or the error message), one per node
+  '''
+  _l = logging.getLogger('applyNodeChanges')
+  entries = groupNodeChanges(changes)
+  if len(entries) == 0:
+    return []
+  if con is not None:
+    results = _applyNodeChangesLDAP(con, entries)
+  else:
+    if ldap_pass is None:
+      ldap_pass = getpass("Enter LDAP password: ")
+    results = _applyNodeChangesLdapmodify(nodeChangesLDIF(changes), [e[0] for e in entries], ldap_pass)
+  report = []
+  for dn, attributes in entries:
+    if results[dn] != LDAP_RESULT_OK:
+      _l.error("%s: %s", dn, results[dn])
+    report.append({'dn': dn, 'changes': attributes, 'result': results[dn]})
+  return report
+
+
+def _applyNodeChangesLdapmodify(ldif, dns, ldap_pass):
+  from fabric.api import put, run, settings, hide
+  remote_file = tmpFileName(tmp_dir="/tmp", prefix="nodeupdate", ext="ldiff")
+  put(StringIO(ldif), remote_file, mode=0o600)
+  #stdout is line buffered so each error follows the record it belongs to
+  cmd = "stdbuf -oL ldapmodify -c -H {0} -D {1} ".format(LDAP_URI, LDAP_ADMIN_DN)
+  cmd += " -w '{0}' ".format(ldap_pass)
+  cmd += " -f {0} 2>&1; status=$?; rm -f {0}; exit $status".format(remote_file)
+  #-c exits non-zero if any record failed, the records are checked individually
+  with settings(hide('running'), warn_only=True):
+    output = run(cmd, pty=False)
+  return parseLdapmodifyOutput(output, dns, return_code=output.return_code)
+
+
+def _applyNodeChangesLDAP(con, entries):
+  import ldap
+  results = {}
+  outstanding = []
+  for dn, attributes in entries:
+    mod_list = [(ldap.MOD_REPLACE, attribute, [str(value).encode('utf-8')])
+                for attribute, value in attributes]
+    try:
+      outstanding.append((dn, con.modify(dn, mod_list)))
+    except ldap.LDAPError as e:
+      results[dn] = str(e)
+  for dn, msgid in outstanding:
+    try:
+      con.result3(msgid, all=1)
+      results[dn] = LDAP_RESULT_OK
+    except ldap.LDAPError as e:
+      results[dn] = str(e)
+  return results
+
+
+def _applySingleNodeChange(node_id, attribute, value, ldap_pass=None, con=None):
+  report = applyNodeChanges([(node_id, attribute, value)], ldap_pass=ldap_pass, con=con)
+  logging.info("%s %s=%s: %s", report[0]['dn'], attribute, value, report[0]['result'])
+  return report[0]
+
+
+def setNodeSynchronize(node_id, state, ldap_pass=None, con=None):
   '''Adjust the LDAP entry for the specified node to indicate if node should be synchronized
 
   Attributes:
     node_id (str): The node entry to adjust
     state (str): Either "up" or "down"
   '''
-  node_id = expandNodeID(node_id)
   state = state.lower()
   if state not in ("up", "down"):
     raise ValueError("State must be 'up' or 'down'")
-  if ldap_pass is None:
-    ldap_pass = getpass("Enter LDAP password: ")
-  ldiff = StringIO()
-  ldiff.write("dn: cn={0},dc=dataone,dc=org\n".format(node_id))
-  ldiff.write("changetype: modify\n")
-  ldiff.write("replace: d1NodeState\n")
-  ldiff.write("d1NodeState: {0}\n".format(state));
-  remote_file = "nodeupdate.ldiff"
-  put(ldiff, remote_file)
-  cmd = "cat " + remote_file + "; "
-  cmd += "ldapmodify -H ldap://localhost -D cn=admin,dc=dataone,dc=org "
-  cmd += " -w '{0}' ".format(ldap_pass)
-  cmd += " -f {0}".format(remote_file)
-  run(cmd)
+  return _applySingleNodeChange(node_id, "d1NodeState", state, ldap_pass=ldap_pass, con=con)
 
 
-def setNodeState(node_id, state, ldap_pass=None):
+def setNodeState(node_id, state, ldap_pass=None, con=None):
   '''Adjust the LDAP entry for the specified node to indicate if node is online.
 
   Attributes:
     node_id (str): The node entry to adjust
     state (str): Either "up" or "down"
   '''
-  node_id = expandNodeID(node_id)
   state = state.lower()
   if state not in ("up", "down"):
     raise ValueError("State must be 'up' or 'down'")
-  if ldap_pass is None:
-    ldap_pass = getpass("Enter LDAP password: ")
-  ldiff = StringIO()
-  ldiff.write("dn: cn={0},dc=dataone,dc=org\n".format(node_id))
-  ldiff.write("changetype: modify\n")
-  ldiff.write("replace: d1NodeState\n")
-  ldiff.write("d1NodeState: {0}\n".format(state));
-  remote_file = "nodeupdate.ldiff"
-  put(ldiff, remote_file)
-  cmd = "cat " + remote_file + "; "
-  cmd += "ldapmodify -H ldap://localhost -D cn=admin,dc=dataone,dc=org "
-  cmd += " -w '{0}' ".format(ldap_pass)
-  cmd += " -f {0}".format(remote_file)
-  run(cmd)
+  return _applySingleNodeChange(node_id, "d1NodeState", state, ldap_pass=ldap_pass, con=con)
 
 
-def approveNode(node_id, ldap_pass=None, approval=False):
+def approveNode(node_id, ldap_pass=None, approval=False, con=None):
   '''Adjust the LDAP entry for a node, indicating if approved or not.
 
   Attributes:
     node_id (str): The node entry to adjust
     approval (bool): True or False
   '''
-  node_id = expandNodeID(node_id)
   state = str(approval).upper()
   if state not in ("TRUE", "FALSE"):
     raise ValueError("State must be 'TRUE' or 'FALSE'")
-  if ldap_pass is None:
-    ldap_pass = getpass("Enter LDAP password: ")
-  ldiff = StringIO()
-  ldiff.write("dn: cn={0},dc=dataone,dc=org\n".format(node_id))
-  ldiff.write("changetype: modify\n")
-  ldiff.write("replace: d1NodeApproved\n")
-  ldiff.write("d1NodeApproved: {0}\n".format(state));
-  remote_file = "nodeupdate.ldiff"
-  put(ldiff, remote_file)
-  cmd = "cat " + remote_file + "; "
-  cmd += "ldapmodify -H ldap://localhost -D cn=admin,dc=dataone,dc=org "
-  cmd += " -w '{0}' ".format(ldap_pass)
-  cmd += " -f {0}".format(remote_file)
-  run(cmd)
+  return _applySingleNodeChange(node_id, "d1NodeApproved", state, ldap_pass=ldap_pass, con=con)
 
 
-def resetNodeHarvestDate(node_id, ldap_pass=None, harvest_timestamp="1900-01-01T00:00:00Z"):
+def resetNodeHarvestDate(node_id, ldap_pass=None, harvest_timestamp="1900-01-01T00:00:00Z", con=None):
   '''Reset the last harvest date for a MN.
   '''
-  node_id = expandNodeID(node_id)
-  if ldap_pass is None:
-    ldap_pass = getpass("Enter LDAP password: ")
-  ldiff = StringIO()
-  ldiff.write("dn: cn={0},dc=dataone,dc=org\n".format(node_id))
-  ldiff.write("changetype: modify\n")
-  ldiff.write("replace: d1NodeLastHarvested\n")
-  ldiff.write("d1NodeLastHarvested: {0}\n".format(harvest_timestamp));
-  remote_file = "nodeupdate.ldiff"
-  put(ldiff, remote_file)
-  cmd = "cat " + remote_file + "; "
-  cmd += "ldapmodify -H ldap://localhost -D cn=admin,dc=dataone,dc=org "
-  cmd += " -w '{0}' ".format(ldap_pass)
-  cmd += " -f {0}".format(remote_file)
-  run(cmd)
+  return _applySingleNodeChange(node_id, "d1NodeLastHarvested", harvest_timestamp, ldap_pass=ldap_pass, con=con)
 
 
-def resetNodeLogAggregationDate(node_id, ldap_pass=None, harvest_timestamp="1900-01-01T00:00:00Z"):
+def resetNodeLogAggregationDate(node_id, ldap_pass=None, harvest_timestamp="1900-01-01T00:00:00Z", con=None):
   '''Reset the last log aggregation harvest date for a MN.
   '''
-  node_id = expandNodeID(node_id)
-  if ldap_pass is None:
-    ldap_pass = getpass("Enter LDAP password: ")
-  ldiff = StringIO()
-  ldiff.write("dn: cn={0},dc=dataone,dc=org\n".format(node_id))
-  ldiff.write("changetype: modify\n")
-  ldiff.write("replace: d1NodeLogLastAggregated\n")
-  ldiff.write("d1NodeLogLastAggregated: {0}\n".format(harvest_timestamp));
-  remote_file = "nodeupdate.ldiff"
-  put(ldiff, remote_file)
-  cmd = "cat " + remote_file + "; "
-  cmd += "ldapmodify -H ldap://localhost -D cn=admin,dc=dataone,dc=org "
-  cmd += " -w '{0}' ".format(ldap_pass)
-  cmd += " -f {0}".format(remote_file)
-  run(cmd)
+  return _applySingleNodeChange(node_id, "d1NodeLogLastAggregated", harvest_timestamp, ldap_pass=ldap_pass, con=con)
 
 
 #========================
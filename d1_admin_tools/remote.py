@@ -0,0 +1,309 @@
+'''
+Streaming command output from hosts over SSH.
+
+Output is read from the SSH channel as it is produced, so large results such as
+a psql COPY or a directory listing can be processed without first being
+written to a file on the remote host and copied back. Host settings are read
+from ~/.ssh/config, as they are for ssh, and authentication uses the SSH agent
+or default keys.
+'''
+
+import io
+import os
+import csv
+import uuid
+import queue
+import logging
+import threading
+import paramiko
+
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_BATCH_ROWS = 10000 #Rows per batch passed from host readers to the consumer
+DEFAULT_QUEUE_BATCHES = 16 #Batches buffered between host readers and the consumer
+READ_BUFFER_SIZE = 1048576
+
+
+class RemoteCommandError(Exception):
+  '''
+  Raised when a remote command exits with a non-zero status.
+  '''
+
+  def __init__(self, host, command, exit_status, stderr):
+    self.host = host
+    self.command = command
+    self.exit_status = exit_status
+    self.stderr = stderr
+    super(RemoteCommandError, self).__init__(
+      "{0}: exit status {1}: {2}".format(host, exit_status, stderr.strip()))
+
+
+class RemoteHost(object):
+  '''
+  An SSH connection to a host, used as a context manager.
+  '''
+
+  def __init__(self, host, user=None, port=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+    self._L = logging.getLogger(self.__class__.__name__)
+    self.host = host
+    self.user = user
+    self.port = port
+    self.connect_timeout = connect_timeout
+    self._client = None
+
+
+  def __enter__(self):
+    self.connect()
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def _sshConfig(self):
+    config_path = os.path.expanduser("~/.ssh/config")
+    if not os.path.exists(config_path):
+      return {}
+    ssh_config = paramiko.SSHConfig()
+    with open(config_path) as config_file:
+      ssh_config.parse(config_file)
+    return ssh_config.lookup(self.host)
+
+
+  def connect(self):
+    '''
+    Open the connection if not already open.
+    '''
+    if self._client is not None:
+      return
+    options = self._sshConfig()
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    port = self.port
+    if port is None:
+      port = int(options.get('port', 22))
+    user = self.user
+    if user is None:
+      user = options.get('user')
+    self._L.debug("Connecting to %s", self.host)
+    client.connect(options.get('hostname', self.host),
+                   port=port,
+                   username=user,
+                   key_filename=options.get('identityfile'),
+                   timeout=self.connect_timeout)
+    self._client = client
+
+
+  def close(self):
+    if self._client is not None:
+      self._client.close()
+      self._client = None
+
+
+  def openChannel(self, command):
+    '''
+    Start command on the host.
+
+    :param command: shell command to run on the host
+    :return: paramiko.Channel for the stdin, stdout and stderr of command
+    '''
+    self.connect()
+    self._L.debug("%s: %s", self.host, command)
+    channel = self._client.get_transport().open_session()
+    channel.exec_command(command)
+    return channel
+
+
+  def streamLines(self, command):
+    '''
+    Generator of the lines written to stdout by command, as they arrive.
+
+    :param command: shell command to run on the host
+    :return: yields str, each line including its line terminator
+    :raises RemoteCommandError: if the command exits with a non-zero status
+    '''
+    channel = self.openChannel(command)
+    try:
+      stdout = channel.makefile('rb', READ_BUFFER_SIZE)
+      for line in stdout:
+        yield line.decode('utf-8')
+      exit_status = channel.recv_exit_status()
+      if exit_status != 0:
+        stderr = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        raise RemoteCommandError(self.host, command, exit_status, stderr)
+    finally:
+      channel.close()
+
+
+class PsqlSession(object):
+  '''
+  A psql process on a remote host that runs queries sent over one SSH channel.
+
+  The connection and the psql process are kept open between queries, so
+  repeated queries, such as periodic samples, avoid the cost of connecting. The
+  end of the output of each query is found by echoing a unique marker after it,
+  followed by the psql ERROR and SQLSTATE variables of the query. Errors are
+  detected from these rather than from stderr, which is a separate SSH stream
+  and may arrive after the marker.
+  '''
+
+  def __init__(self, remote_host, database, user, psql_options=''):
+    '''
+    :param remote_host: instance of RemoteHost
+    :param database: name of the database
+    :param user: postgres user, authenticated by .pgpass or similar on the host
+    :param psql_options: additional command line options for psql
+    '''
+    self._L = logging.getLogger(self.__class__.__name__)
+    self.remote_host = remote_host
+    self.database = database
+    self.user = user
+    self.psql_options = psql_options
+    self._marker = "__END_{0}__".format(uuid.uuid4().hex)
+    self._channel = None
+    self._stdin = None
+    self._stdout = None
+
+
+  def __enter__(self):
+    self.open()
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def open(self):
+    if self._channel is not None:
+      return
+    #psql output to a pipe is block buffered, line buffering lets the marker through
+    #ON_ERROR_STOP=0 keeps psql running after a failed query so the marker follows
+    cmd = "stdbuf -oL psql -X -q -h localhost -U {0} {1} -P pager=off -v ON_ERROR_STOP=0 {2}".format(
+      self.user, self.database, self.psql_options)
+    channel = self.remote_host.openChannel(cmd)
+    self._channel = channel
+    self._stdin = channel.makefile_stdin('wb')
+    self._stdout = channel.makefile('rb')
+
+
+  def close(self):
+    if self._channel is None:
+      return
+    try:
+      self._stdin.write(b"\\q\n")
+      self._stdin.flush()
+    except (OSError, EOFError):
+      pass
+    self._channel.close()
+    self._channel = None
+
+
+  def copyRows(self, SQL):
+    '''
+    Run a SELECT statement and return its rows.
+
+    :param SQL: SELECT statement, without a terminating semicolon
+    :return: list of rows, each a list of str
+    :raises RemoteCommandError: if psql reports an error or exits
+    '''
+    self.open()
+    command = "COPY (" + SQL + ") TO STDOUT WITH (FORMAT CSV);\n"
+    command += "\\echo " + self._marker + " :ERROR :SQLSTATE\n"
+    self._stdin.write(command.encode('utf-8'))
+    self._stdin.flush()
+    lines = []
+    while True:
+      line = self._stdout.readline()
+      if len(line) == 0:
+        exit_status = self._channel.recv_exit_status()
+        stderr = self._readStderr()
+        self._channel = None
+        raise RemoteCommandError(self.remote_host.host, "psql", exit_status, stderr)
+      line = line.decode('utf-8')
+      if line.startswith(self._marker):
+        status = line.rstrip('\r\n').split()[1:]
+        break
+      lines.append(line)
+    #Drain stderr so notices or late output are not reported with a later query
+    stderr = self._readStderr()
+    if status[:1] == ["false"]:
+      return list(csv.reader(io.StringIO("".join(lines))))
+    if status[:1] == ["true"]:
+      message = stderr.strip() or "SQLSTATE {0}".format(" ".join(status[1:]))
+      raise RemoteCommandError(self.remote_host.host, SQL, 0, message)
+    #psql before 11 has no ERROR variable, fall back to what stderr holds so far
+    if "ERROR" in stderr:
+      raise RemoteCommandError(self.remote_host.host, SQL, 0, stderr)
+    return list(csv.reader(io.StringIO("".join(lines))))
+
+
+  def _readStderr(self):
+    data = b""
+    while self._channel.recv_stderr_ready():
+      data += self._channel.recv_stderr(65536)
+    return data.decode('utf-8', 'replace')
+
+
+def streamFromHosts(hosts,
+                    produce,
+                    batch_rows=DEFAULT_BATCH_ROWS,
+                    queue_batches=DEFAULT_QUEUE_BATCHES,
+                    **kwargs):
+  '''
+  Run produce against each host in parallel, yielding rows to a single consumer.
+
+  Each host is read by its own thread over its own connection. Rows are passed
+  back in batches through a bounded queue, so a slow consumer slows the readers
+  rather than accumulating rows in memory. The consumer, typically a single
+  database writer, receives batches from all hosts as they arrive.
+
+  :param hosts: list of host names
+  :param produce: callable(remote_host) returning an iterable of rows
+  :param kwargs: passed to the RemoteHost constructor
+  :return: yields (host, list of rows). After the last batch from a host,
+    (host, None) is yielded to indicate the host is complete.
+  :raises: the first exception raised by a reader, after all readers have finished
+  '''
+  _l = logging.getLogger('streamFromHosts')
+  batches = queue.Queue(maxsize=queue_batches)
+
+  def reader(host):
+    try:
+      with RemoteHost(host, **kwargs) as remote_host:
+        batch = []
+        for row in produce(remote_host):
+          batch.append(row)
+          if len(batch) >= batch_rows:
+            batches.put((host, batch))
+            batch = []
+        if len(batch) > 0:
+          batches.put((host, batch))
+      batches.put((host, None))
+    except Exception as e:
+      _l.error("%s: %s", host, e)
+      batches.put((host, e))
+
+  threads = []
+  for host in hosts:
+    thread = threading.Thread(target=reader, args=(host, ), name=host, daemon=True)
+    thread.start()
+    threads.append(thread)
+  error = None
+  remaining = len(threads)
+  while remaining > 0:
+    host, batch = batches.get()
+    if isinstance(batch, Exception):
+      remaining -= 1
+      if error is None:
+        error = batch
+      continue
+    if batch is None:
+      remaining -= 1
+    if error is None:
+      yield host, batch
+  for thread in threads:
+    thread.join()
+  if error is not None:
+    raise error
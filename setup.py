@@ -69,6 +69,7 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['requests',
                       'fabric3',
+                      'paramiko',
                       'xmljson',
                       'dateparser',
                       'humanize',
@@ -107,6 +108,7 @@ setup(
              'scripts/d1resolve',
              'scripts/d1sysmeta',
              'scripts/d1nodes',
+             'scripts/d1nodemonitor',
              'scripts/d1facets',
              'scripts/d1getpids',
              'scripts/d1fields',